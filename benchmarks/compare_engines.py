@@ -0,0 +1,119 @@
+"""
+Compare the forward model engines of the reflecting diffusion fitter
+
+Evaluates the 'series' and 'crank_nicolson' engines at fixed (D, koff, Iinf)
+on a synthetic FRAP profile, checks both against a series with many terms
+and times one model evaluation for different movie lengths.
+
+    python benchmarks/compare_engines.py   (with frapdiff installed, e. g. pip install -e .)
+
+Exits with status 1 when an engine deviates more than its tolerance.
+"""
+
+import io
+import sys
+import time
+import contextlib
+import numpy as np
+
+from frapdiff.reflecting_diffusion_fitter import reflect_diffusion_model
+
+
+PIXEL_SIZE = 0.1
+N_POSITIONS = 30
+T_STEP_SIZE = 2.0
+I0 = I1 = 1.0
+
+# maximum absolute deviation from the reference after the first frame
+TOLERANCES = {"series": 1e-2, "crank_nicolson": 5e-3}
+
+
+def synthetic_profile():
+    """
+    Positions and segment intensities of a Gaussian bleach profile
+    """
+    x_positions = np.arange(N_POSITIONS) * PIXEL_SIZE
+    center = x_positions[-1] / 2
+    z = 1.0 - 0.6 * np.exp(-((x_positions - center) ** 2) / (2 * 0.6**2))
+    segment_intensities = 0.5 * (z[:-1] + z[1:])
+    return x_positions, segment_intensities
+
+
+def iinf_for_x_l(x_positions, segment_intensities, x_l):
+    z_integral = np.sum(segment_intensities * np.diff(x_positions))
+    length = x_positions[-1] - x_positions[0]
+    return (z_integral + x_l * (I0 + I1)) / (2 * x_l + length)
+
+
+def evaluate(model, x_positions, n_frames, D, koff, Iinf):
+    x, t = np.meshgrid(x_positions, np.arange(n_frames) * T_STEP_SIZE, indexing="ij")
+    # the models print each evaluation
+    with contextlib.redirect_stdout(io.StringIO()):
+        return model([x.ravel(), t.ravel()], D, koff, Iinf).reshape(x.shape)
+
+
+def check_accuracy(x_positions, segment_intensities, n_frames=50):
+    reference, _ = reflect_diffusion_model(
+        x_positions, segment_intensities, I0, I1, T_STEP_SIZE, max_n=4000
+    )
+    models = {
+        engine: reflect_diffusion_model(
+            x_positions, segment_intensities, I0, I1, T_STEP_SIZE, engine=engine
+        )[0]
+        for engine in TOLERANCES
+    }
+
+    print("max. abs. deviation from a 4000-term series (t = 0 / t > 0)")
+    passed = True
+    for D in [0.005, 0.05, 0.5]:
+        for koff in [0.0, 0.05]:
+            for x_l in [8.0, 16.0]:
+                Iinf = iinf_for_x_l(x_positions, segment_intensities, x_l)
+                expected = evaluate(reference, x_positions, n_frames, D, koff, Iinf)
+
+                line = f"  D={D:<6} koff={koff:<5} x_l={x_l:<5}"
+                for engine, model in models.items():
+                    error = np.abs(
+                        evaluate(model, x_positions, n_frames, D, koff, Iinf) - expected
+                    )
+                    line += f" {engine}: {error[:, 0].max():.1e} / {error[:, 1:].max():.1e}"
+                    passed &= bool(error[:, 1:].max() <= TOLERANCES[engine])
+                print(line)
+
+    return passed
+
+
+def benchmark(x_positions, segment_intensities, repeats=5):
+    Iinf = iinf_for_x_l(x_positions, segment_intensities, 12.0)
+
+    print("time per model evaluation (basis cached)")
+    for n_frames in [200, 1000]:
+        line = f"  {n_frames:>5} frames:"
+        for engine in TOLERANCES:
+            model, _ = reflect_diffusion_model(
+                x_positions, segment_intensities, I0, I1, T_STEP_SIZE, engine=engine
+            )
+            evaluate(model, x_positions, n_frames, 0.05, 0.01, Iinf)
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                evaluate(model, x_positions, n_frames, 0.05, 0.01, Iinf)
+            elapsed = (time.perf_counter() - start) / repeats
+            line += f" {engine} {1000 * elapsed:.1f} ms"
+        print(line)
+
+
+def main():
+    x_positions, segment_intensities = synthetic_profile()
+
+    passed = check_accuracy(x_positions, segment_intensities)
+    benchmark(x_positions, segment_intensities)
+
+    if not passed:
+        print("FAILED: deviation above tolerance", TOLERANCES)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
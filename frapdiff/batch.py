@@ -0,0 +1,283 @@
+import os
+import time
+import collections
+import numpy
+import tempfile
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+
+class JobError(RuntimeError):
+    """
+    Error raised by a job in a worker process, with the worker's traceback
+    """
+
+
+class JobTimeout(TimeoutError):
+    """
+    Job stopped by the batch runner after exceeding its time limit
+    """
+
+
+# arrays of at least this size are handed to worker processes as memory-mapped
+# files instead of being pickled
+SHARED_ARRAY_MIN_BYTES = 1 << 16
+
+# fresh worker processes, forked ones would inherit the parent's matplotlib
+# and FreeType state
+WORKER_START_METHOD = "spawn"
+
+
+class SharedArray:
+    """
+    Picklable handle of a NumPy array stored in a temporary .npy file
+
+    Worker processes map the file read-only instead of receiving a pickled
+    copy, all workers share the same pages of the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        return numpy.load(self.filename, mmap_mode="r")
+
+
+def share_job_arrays(jobs, tmp_dir):
+    """
+    Replace the large arrays in the job dicts by SharedArray handles
+
+    An array used by several jobs (e. g. the profiles of one plane fitted with
+    different parameters) is stored once.
+    """
+    shared = {}
+
+    def share(value):
+        if not isinstance(value, numpy.ndarray):
+            return value
+        if value.nbytes < SHARED_ARRAY_MIN_BYTES:
+            return value
+        if id(value) not in shared:
+            filename = os.path.join(tmp_dir, f"array_{len(shared)}.npy")
+            numpy.save(filename, value)
+            shared[id(value)] = SharedArray(filename)
+        return shared[id(value)]
+
+    return [{key: share(value) for key, value in job.items()} for job in jobs]
+
+
+def _run_job(func, job):
+    try:
+        job = {
+            key: value.load() if isinstance(value, SharedArray) else value
+            for key, value in job.items()
+        }
+        return func(**job)
+    except Exception:
+        return JobError(traceback.format_exc())
+
+
+# sent by a worker once it has started, before it takes jobs
+_WORKER_READY = "ready"
+
+
+def _worker_loop(connection, func):
+    # run the jobs sent by the parent until it sends None or closes the pipe
+    connection.send(_WORKER_READY)
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        connection.send(_run_job(func, job))
+    connection.close()
+
+
+class _Worker:
+    """
+    Long-lived worker process, running one job at a time
+    """
+
+    def __init__(self, context, func):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_worker_loop, args=(child_connection, func), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+        self.job_index = None
+        self.job_start = None
+
+    def wait_ready(self):
+        """
+        Wait until the worker has started, False if it died while starting
+        """
+        try:
+            return self.connection.recv() == _WORKER_READY
+        except (EOFError, OSError):
+            return False
+
+    def exit_error(self):
+        self.process.join(1)
+        return JobError(f"Worker process exited with code {self.process.exitcode}")
+
+    def submit(self, job_index, job):
+        """
+        Send a job to the worker, returns a JobError if the worker died
+        """
+        try:
+            self.connection.send(job)
+        except OSError:
+            return self.exit_error()
+        self.job_index = job_index
+        self.job_start = time.monotonic()
+        return None
+
+    def receive(self):
+        """
+        Result of the running job, JobError if the worker died
+        """
+        job_index, self.job_index = self.job_index, None
+        try:
+            return job_index, self.connection.recv()
+        except (EOFError, OSError):
+            return job_index, self.exit_error()
+
+    def stop(self):
+        if self.job_index is None and self.process.is_alive():
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+def run_jobs(func, jobs, n_workers=None, timeout=None):
+    """
+    Run func(**job) for each job dict, in parallel processes
+
+    Returns the results in order of the jobs. Jobs raising an error return
+    the exception instead of a result, so that one failing job does not stop
+    the others. The jobs are fed to n_workers long-lived worker processes.
+    A worker whose job runs longer than timeout seconds is terminated and
+    replaced (the job then returns a JobTimeout), so that a stuck job does not
+    block it for the rest of the batch. Without timeout and with n_workers=1
+    (or a single job) all jobs run in-process.
+
+    Workers are started with the 'spawn' method (forked workers inherit the
+    parent's matplotlib state and can fail when saving plots). Large arrays
+    in the jobs are handed to them as memory-mapped files (see SharedArray).
+    Spawned workers re-run the caller's __main__ module, so scripts calling
+    run_jobs need an 'if __name__ == "__main__":' guard. Without it, the
+    workers fail to start and all jobs run in-process (without timeout).
+    """
+    if n_workers is None:
+        n_workers = min(len(jobs), os.cpu_count() or 1)
+
+    if timeout is None and (n_workers <= 1 or len(jobs) <= 1):
+        return _run_jobs_in_process(func, jobs)
+
+    with tempfile.TemporaryDirectory(prefix="frapdiff_") as tmp_dir:
+        results = _run_jobs_in_processes(
+            func, share_job_arrays(jobs, tmp_dir), n_workers, timeout
+        )
+    if results is not None:
+        return results
+
+    print(
+        "  -- worker processes failed to start, running all jobs in this process. "
+        "Scripts using parallel jobs need an 'if __name__ == \"__main__\":' guard"
+    )
+    return _run_jobs_in_process(func, jobs)
+
+
+def _run_jobs_in_process(func, jobs):
+    results = [None] * len(jobs)
+    for i, job in enumerate(jobs):
+        try:
+            results[i] = func(**job)
+        except Exception as e:
+            results[i] = e
+    return results
+
+
+def _run_jobs_in_processes(func, jobs, n_workers, timeout):
+    """
+    Returns None, without running any job, when the workers fail to start
+    """
+    context = multiprocessing.get_context(WORKER_START_METHOD)
+    results = [None] * len(jobs)
+    pending = collections.deque(range(len(jobs)))
+    workers = [
+        _Worker(context, func) for _ in range(min(max(n_workers, 1), len(jobs)))
+    ]
+    try:
+        # e. g. when the caller's __main__ module, re-run by each spawned
+        # worker, starts the batch again
+        if not all([worker.wait_ready() for worker in workers]):
+            return None
+
+        while True:
+            # feed idle workers, (re)starting the ones that were stopped
+            for k, worker in enumerate(workers):
+                if len(pending) == 0:
+                    break
+                if worker is None:
+                    worker = workers[k] = _Worker(context, func)
+                    if not worker.wait_ready():
+                        i = pending.popleft()
+                        results[i] = worker.exit_error()
+                        worker.stop()
+                        workers[k] = None
+                        continue
+                if worker.job_index is None:
+                    i = pending.popleft()
+                    error = worker.submit(i, jobs[i])
+                    if error is not None:
+                        results[i] = error
+                        worker.stop()
+                        workers[k] = None
+
+            busy = [w for w in workers if w is not None and w.job_index is not None]
+            if len(busy) == 0:
+                if len(pending) > 0:
+                    continue
+                break
+
+            wait_time = None
+            if timeout is not None:
+                first_deadline = min(worker.job_start for worker in busy) + timeout
+                wait_time = max(first_deadline - time.monotonic(), 0)
+
+            ready = multiprocessing.connection.wait(
+                [worker.connection for worker in busy], wait_time
+            )
+
+            for k, worker in enumerate(workers):
+                if worker is None or worker.job_index is None:
+                    continue
+                if worker.connection in ready:
+                    i, results[i] = worker.receive()
+                    if not worker.process.is_alive():
+                        worker.stop()
+                        workers[k] = None
+                elif timeout is not None and time.monotonic() - worker.job_start > timeout:
+                    # only the worker of the overdue job is replaced
+                    results[worker.job_index] = JobTimeout(
+                        f"Job stopped after exceeding the time limit of {timeout} s"
+                    )
+                    worker.stop()
+                    workers[k] = None
+    finally:
+        for worker in workers:
+            if worker is not None:
+                worker.stop()
+
+    return results
@@ -1,11 +1,9 @@
-import os
 import re
 import sys
 import json
 import numpy
+import itertools
 import pandas
-import roifile
-import tifffile
 import traceback
 
 from pathlib import Path
@@ -13,20 +11,23 @@ from matplotlib import pyplot as plt
 from gooey import Gooey, GooeyParser
 
 from .reflecting_diffusion_fitter import run_fitter
-
-
-def get_physical_units_from_imagej_tif(tif_fn):
-    with tifffile.TiffFile(tif_fn) as tif:
-        assert tif.is_imagej
-        tags = tif.pages[0].tags
-        y_resolution = tags["YResolution"].value
-        finterval = tif.imagej_metadata["finterval"]
-
-        pixel_size = y_resolution[1] / y_resolution[0]
-        return pixel_size, finterval
+from .batch import run_jobs, JobTimeout
+from .movie_io import (
+    open_movie,
+    movie_planes,
+    select_plane,
+    plane_suffix,
+    # re-exported for backward compatibility
+    get_physical_units_from_imagej_tif,
+)
 
 
 def simple_bleach_correction(mov, win_size):
+    """
+    Ratio bleach correction of the full movie, kept for backward compatibility
+
+    The pipeline only reads the correction window, see bleach_correction_trace.
+    """
     roi_values = mov[:, :win_size, :win_size]
     roi_values_mean = roi_values.mean(axis=(1, 2))
 
@@ -34,36 +35,13 @@ def simple_bleach_correction(mov, win_size):
     return mov_corr
 
 
-def extract_frap_profiles_and_fit(
-    mov_fn,
-    bleach_correction=True,
-    roi_ext_factor=1.5,
-    project_on="v",
-    mirror="first_half",
-    D_guess=0.05,
-    koff_guess=0.1,
-    min_l_f=8,
-    max_l_f=16,
-    correction_region_size=150,
-):
-
-    roi = roifile.ImagejRoi.fromfile(str(mov_fn))
-    if len(roi) == 0:
-        extra_roi_file = str(mov_fn)[:-4] + ".roi"
-        if os.path.exists(extra_roi_file):
-            roi = roifile.ImagejRoi.fromfile(extra_roi_file)
-            print("Cannot read ROI from tiff file, using .roi file...")
-        else:
-            raise RuntimeError("No ROI found in '{mov_fn}' or '{extra_roi_file}'")
-    else:
-        roi = roi[0]
-
-    pixel_size, finterval = get_physical_units_from_imagej_tif(str(mov_fn))
-
-    mov = tifffile.imread(str(mov_fn))
-    if bleach_correction:
-        mov = simple_bleach_correction(mov, correction_region_size)
+def project_roi_strip(mov, roi, roi_ext_factor=1.5, project_on="v"):
+    """
+    Read the ROI strip, extended on both sides, and project it on its long axis
 
+    Only the strip is read, which for lazily opened (e. g. Zarr) movies avoids
+    fetching the full stack.
+    """
     if project_on == "v":
         roi_height = roi.bottom - roi.top
         roi_extension = int(roi_height * roi_ext_factor)
@@ -93,6 +71,54 @@ def extract_frap_profiles_and_fit(
     else:
         raise ValueError(f"Value for 'project_on' not understood. Use 'v' or 'h'")
 
+    return roi_values_projected
+
+
+def bleach_correction_trace(mov, win_size):
+    """
+    Mean intensity per frame in the upper-left bleach-correction window
+    """
+    return mov[:, :win_size, :win_size].mean(axis=(1, 2))
+
+
+def extract_frap_profiles(
+    mov,
+    roi,
+    pixel_size,
+    bleach_correction=True,
+    roi_ext_factor=1.5,
+    project_on="v",
+    mirror="first_half",
+    correction_region_size=150,
+):
+    """
+    Extract the FRAP recovery profiles of one (T, Y, X) movie plane
+
+    Returns (profiles, I0, time_bleach), where the profiles have one row per
+    position: location followed by the intensities of each post-bleach frame.
+    """
+    roi_values_projected = project_roi_strip(mov, roi, roi_ext_factor, project_on)
+
+    if bleach_correction:
+        bleach_trace = bleach_correction_trace(mov, correction_region_size)
+    else:
+        bleach_trace = None
+
+    return profiles_from_projection(
+        roi_values_projected, pixel_size, bleach_trace=bleach_trace, mirror=mirror
+    )
+
+
+def profiles_from_projection(
+    roi_values_projected, pixel_size, bleach_trace=None, mirror="first_half"
+):
+    """
+    Bleach-correct and normalize the projected ROI strip, see extract_frap_profiles
+    """
+    if bleach_trace is not None:
+        # the ratio correction is per frame and commutes with the projection
+        roi_values_projected = (roi_values_projected.T / bleach_trace).T
+
     # Find frame of bleaching
     time_bleach = numpy.argmax(numpy.abs(numpy.diff(roi_values_projected.mean(1)))) + 1
 
@@ -130,40 +156,447 @@ def extract_frap_profiles_and_fit(
     # print("I0", I0)
     # print("time of bleach", time_bleach)
 
-    data = pandas.DataFrame(data.T)
-    data.insert(0, "loc", pixel_size * numpy.arange(data.shape[0]))
+    profiles = numpy.c_[pixel_size * numpy.arange(data.shape[1]), data.T]
 
-    print("  -- create table with projected ROI values")
-    data_fn = str(mov_fn)[:-4] + f"_frap_recovery_proj.txt"
-    data.to_csv(data_fn, "\t", header=False, index=False)
+    return profiles, I0, time_bleach
 
-    result_fn = str(mov_fn)[:-4] + f"_results.json"
-    print("  -- run fit routine...")
+
+def fit_frap_profiles(
+    profiles,
+    name,
+    out_prefix,
+    I0,
+    pixel_size,
+    finterval,
+    time_bleach,
+    D_guess=0.05,
+    koff_guess=0.1,
+    min_l_f=8,
+    max_l_f=16,
+    max_num_points=1000,
+    time_sampling="first",
+    engine="series",
+    time_limit=None,
+    max_nfev=None,
+    plot=True,
+    extra_results=None,
+):
+    """
+    Fit the FRAP recovery profiles, the profile table and the results are
+    written next to the movie (skipped for out_prefix=None)
+
+    With plot=True, data and fitted model of each frame are plotted to Images.
+    """
+    if out_prefix is not None:
+        print(f"  -- create table with projected ROI values ({name})")
+        data_fn = out_prefix + f"_frap_recovery_proj.txt"
+        pandas.DataFrame(profiles).to_csv(
+            data_fn, sep="\t", header=False, index=False
+        )
+
+    print(f"  -- run fit routine ({name})...")
 
     result = run_fitter(
-        data_fn,
-        mov_fn.stem,
+        profiles,
+        name,
         I0=I0,
         t_step_size=float(finterval),
         D_guess=D_guess,
         koff_guess=koff_guess,
         min_l_f=min_l_f,
         max_l_f=max_l_f,
+        max_num_points=max_num_points,
+        time_sampling=time_sampling,
+        engine=engine,
+        time_limit=time_limit,
+        max_nfev=max_nfev,
+        plot=plot,
     )
 
     result["frameInteval"] = float(finterval)
     result["pixelSize"] = float(pixel_size)
     result["frameOfFrap"] = int(time_bleach)
     result["I0"] = I0
-    result["File"] = str(mov_fn)
+    result.update(extra_results or {})
 
-    print("  -- saving results to json")
-    with open(result_fn, "w") as fh:
-        json.dump(result, fh)
+    if out_prefix is not None:
+        print(f"  -- saving results to json ({name})")
+        with open(out_prefix + f"_results.json", "w") as fh:
+            json.dump(result, fh)
 
     return result
 
 
+PLANE_RESULT_KEYS = {"c": "Channel", "z": "ZPlane"}
+
+
+def prepare_fit_jobs(
+    mov_fn,
+    channels=None,
+    z_planes=None,
+    bleach_correction=True,
+    roi_ext_factor=1.5,
+    project_on="v",
+    mirror="first_half",
+    D_guess=0.05,
+    koff_guess=0.1,
+    min_l_f=8,
+    max_l_f=16,
+    correction_region_size=150,
+    max_num_points=1000,
+    time_sampling="first",
+    engine="series",
+    time_limit=None,
+    max_nfev=None,
+    plot=True,
+    max_read_workers=8,
+):
+    """
+    Open the movie once and extract the profiles of all selected planes
+
+    Returns one keyword dict for fit_frap_profiles per plane.
+    """
+    mov_fn = Path(mov_fn)
+    mov, axes, roi, pixel_size, finterval = open_movie(mov_fn)
+
+    jobs = []
+    for plane in movie_planes(axes, mov.shape, channels=channels, z_planes=z_planes):
+        profiles, I0, time_bleach = extract_frap_profiles(
+            select_plane(mov, axes, plane, max_workers=max_read_workers),
+            roi,
+            pixel_size,
+            bleach_correction=bleach_correction,
+            roi_ext_factor=roi_ext_factor,
+            project_on=project_on,
+            mirror=mirror,
+            correction_region_size=correction_region_size,
+        )
+
+        extra_results = {"File": str(mov_fn)}
+        for ax, i in plane.items():
+            extra_results[PLANE_RESULT_KEYS.get(ax, ax)] = i
+
+        jobs.append(
+            dict(
+                profiles=profiles,
+                name=mov_fn.stem + plane_suffix(plane),
+                out_prefix=str(mov_fn.with_suffix("")) + plane_suffix(plane),
+                I0=I0,
+                pixel_size=pixel_size,
+                finterval=finterval,
+                time_bleach=time_bleach,
+                D_guess=D_guess,
+                koff_guess=koff_guess,
+                min_l_f=min_l_f,
+                max_l_f=max_l_f,
+                max_num_points=max_num_points,
+                time_sampling=time_sampling,
+                engine=engine,
+                time_limit=time_limit,
+                max_nfev=max_nfev,
+                plot=plot,
+                extra_results=extra_results,
+            )
+        )
+
+    return jobs
+
+
+def extract_frap_profiles_and_fit(
+    mov_fn,
+    bleach_correction=True,
+    roi_ext_factor=1.5,
+    project_on="v",
+    mirror="first_half",
+    D_guess=0.05,
+    koff_guess=0.1,
+    min_l_f=8,
+    max_l_f=16,
+    correction_region_size=150,
+    channel=None,
+    z_plane=None,
+    max_num_points=1000,
+    time_sampling="first",
+    engine="series",
+    time_limit=None,
+    max_nfev=None,
+    plot=True,
+    max_read_workers=8,
+):
+    jobs = prepare_fit_jobs(
+        mov_fn,
+        channels=None if channel is None else [channel],
+        z_planes=None if z_plane is None else [z_plane],
+        bleach_correction=bleach_correction,
+        roi_ext_factor=roi_ext_factor,
+        project_on=project_on,
+        mirror=mirror,
+        D_guess=D_guess,
+        koff_guess=koff_guess,
+        min_l_f=min_l_f,
+        max_l_f=max_l_f,
+        correction_region_size=correction_region_size,
+        max_num_points=max_num_points,
+        time_sampling=time_sampling,
+        engine=engine,
+        time_limit=time_limit,
+        max_nfev=max_nfev,
+        plot=plot,
+        max_read_workers=max_read_workers,
+    )
+    if len(jobs) != 1:
+        raise ValueError(
+            f"'{mov_fn}' contains {len(jobs)} planes. Select 'channel' and 'z_plane' or use extract_hyperstack_profiles_and_fit"
+        )
+
+    return fit_frap_profiles(**jobs[0])
+
+
+def extract_hyperstack_profiles_and_fit(
+    mov_fn, channels=None, z_planes=None, n_workers=None, **kwargs
+):
+    """
+    Analyze all selected channels and z-planes of a hyperstack
+
+    The movie is opened once, the fits of the planes run in parallel
+    processes. Returns one result dict per successfully fitted plane.
+    """
+    jobs = prepare_fit_jobs(mov_fn, channels=channels, z_planes=z_planes, **kwargs)
+
+    job_results = run_jobs(
+        fit_frap_profiles,
+        jobs,
+        n_workers,
+        timeout=batch_job_timeout(kwargs.get("time_limit")),
+    )
+    return collect_job_results(jobs, job_results)
+
+
+def batch_job_timeout(time_limit):
+    """
+    Hard time limit of a fit job in the batch runner
+
+    The fit itself stops at time_limit and returns its best parameters, this
+    only stops jobs that do not return. Plots and result files need extra time.
+    """
+    if time_limit is None:
+        return None
+    return 3 * time_limit + 300
+
+
+def collect_job_results(jobs, job_results):
+    """
+    Result dicts of the fit jobs, jobs stopped by the batch runner are marked
+    with fitStatus 'killed', failed jobs are reported and skipped
+    """
+    results = []
+    for job, result in zip(jobs, job_results):
+        if isinstance(result, JobTimeout):
+            print(f"\nTIMEOUT for '{job['name']}': {result}\n")
+            results.append({**job["extra_results"], "fitStatus": "killed"})
+        elif isinstance(result, Exception):
+            print(f"\nERROR for '{job['name']}'\n")
+            traceback.print_exception(type(result), result, result.__traceback__)
+            print()
+        else:
+            results.append(result)
+
+    return results
+
+
+SWEEP_DEFAULTS = dict(
+    bleach_correction=True,
+    correction_region_size=150,
+    roi_ext_factor=1.5,
+    project_on="v",
+    mirror="first_half",
+    D_guess=0.05,
+    koff_guess=0.1,
+    min_l_f=8,
+    max_l_f=16,
+    max_num_points=1000,
+    time_sampling="first",
+    engine="series",
+)
+
+
+def parameter_grid(grid, **defaults):
+    """
+    All combinations of a parameter grid {name: [values]} as parameter sets
+
+    Parameters not in the grid take the given defaults (or SWEEP_DEFAULTS).
+    """
+    unknown = set(grid).union(defaults) - set(SWEEP_DEFAULTS)
+    if len(unknown) > 0:
+        raise ValueError(
+            f"Unknown sweep parameters {sorted(unknown)}. Use {list(SWEEP_DEFAULTS)}"
+        )
+
+    for name, values in grid.items():
+        if not isinstance(values, (list, tuple)):
+            raise ValueError(
+                f"Sweep parameter '{name}' needs a list of values, e. g. [{values!r}], got {values!r}"
+            )
+        if len(values) == 0:
+            raise ValueError(f"Sweep parameter '{name}' has an empty list of values")
+
+    names = list(grid)
+    return [
+        {**SWEEP_DEFAULTS, **defaults, **dict(zip(names, values))}
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def prepare_sweep_jobs(
+    mov_fn,
+    parameter_sets,
+    channels=None,
+    z_planes=None,
+    time_limit=None,
+    max_nfev=None,
+    plot=False,
+    max_read_workers=8,
+):
+    """
+    Open the movie once and extract the profiles for all parameter sets
+
+    Projections, bleach-correction traces and profiles are computed once and
+    shared by all parameter sets using them. Returns one keyword dict for
+    fit_frap_profiles per plane and parameter set.
+    """
+    mov_fn = Path(mov_fn)
+    mov, axes, roi, pixel_size, finterval = open_movie(mov_fn)
+
+    jobs = []
+    for plane in movie_planes(axes, mov.shape, channels=channels, z_planes=z_planes):
+        plane_mov = select_plane(mov, axes, plane, max_workers=max_read_workers)
+
+        projections = {}
+        bleach_traces = {}
+        profile_sets = {}
+        for k, params in enumerate(parameter_sets):
+            projection_key = (params["project_on"], params["roi_ext_factor"])
+            if projection_key not in projections:
+                projections[projection_key] = project_roi_strip(
+                    plane_mov, roi, params["roi_ext_factor"], params["project_on"]
+                )
+
+            bleach_key = None
+            if params["bleach_correction"]:
+                bleach_key = params["correction_region_size"]
+                if bleach_key not in bleach_traces:
+                    bleach_traces[bleach_key] = bleach_correction_trace(
+                        plane_mov, bleach_key
+                    )
+
+            profile_key = projection_key + (bleach_key, params["mirror"])
+            if profile_key not in profile_sets:
+                profile_sets[profile_key] = profiles_from_projection(
+                    projections[projection_key],
+                    pixel_size,
+                    bleach_trace=bleach_traces.get(bleach_key),
+                    mirror=params["mirror"],
+                )
+            profiles, I0, time_bleach = profile_sets[profile_key]
+
+            extra_results = {"File": str(mov_fn)}
+            for ax, i in plane.items():
+                extra_results[PLANE_RESULT_KEYS.get(ax, ax)] = i
+            extra_results["ParameterSet"] = k
+            extra_results.update(params)
+
+            jobs.append(
+                dict(
+                    profiles=profiles,
+                    name=mov_fn.stem + plane_suffix(plane) + f"_p{k}",
+                    out_prefix=None,
+                    I0=I0,
+                    pixel_size=pixel_size,
+                    finterval=finterval,
+                    time_bleach=time_bleach,
+                    D_guess=params["D_guess"],
+                    koff_guess=params["koff_guess"],
+                    min_l_f=params["min_l_f"],
+                    max_l_f=params["max_l_f"],
+                    max_num_points=params["max_num_points"],
+                    time_sampling=params["time_sampling"],
+                    engine=params["engine"],
+                    time_limit=time_limit,
+                    max_nfev=max_nfev,
+                    plot=plot,
+                    extra_results=extra_results,
+                )
+            )
+
+    return jobs
+
+
+def sweep_frap_parameters(
+    mov_fns,
+    grid,
+    channels=None,
+    z_planes=None,
+    n_workers=None,
+    time_limit=None,
+    max_nfev=None,
+    plot=False,
+    max_read_workers=8,
+    **defaults,
+):
+    """
+    Fit all movies for all combinations of the parameter grid
+
+    Each movie is read once, all fits run in parallel processes. Returns a
+    table with one row per movie (plane) and parameter set. The per-frame
+    plots of the fits are skipped unless plot=True.
+    """
+    parameter_sets = parameter_grid(grid, **defaults)
+
+    jobs = []
+    n = len(mov_fns)
+    for i, mov_fn in enumerate(mov_fns):
+        print(f"\n# {i+1}/{n} ### {mov_fn}")
+        sys.stdout.flush()
+        try:
+            jobs += prepare_sweep_jobs(
+                mov_fn,
+                parameter_sets,
+                channels=channels,
+                z_planes=z_planes,
+                time_limit=time_limit,
+                max_nfev=max_nfev,
+                plot=plot,
+                max_read_workers=max_read_workers,
+            )
+        except:
+            print(f"\nERROR for file '{mov_fn}'\n")
+            traceback.print_exc()
+            print()
+
+    print(f"  -- fitting {len(jobs)} profiles of {len(parameter_sets)} parameter sets...")
+    job_results = run_jobs(
+        fit_frap_profiles, jobs, n_workers, timeout=batch_job_timeout(time_limit)
+    )
+    tab = pandas.DataFrame(collect_job_results(jobs, job_results))
+    if len(tab) == 0:
+        return tab
+
+    # movies without channels / z-planes have the single plane 0, so that
+    # sweeps mixing them with hyperstacks keep integer plane indices
+    plane_keys = [key for key in PLANE_RESULT_KEYS.values() if key in tab.columns]
+    for key in plane_keys:
+        tab[key] = tab[key].fillna(0).astype(int)
+
+    index = ["File"] + plane_keys + ["ParameterSet"]
+    return tab.set_index(index)
+
+
+def parse_index_list(value):
+    if value.strip().lower() == "all":
+        return None
+    return [int(v) for v in value.split(",")]
+
+
 # this needs to be *before* the @Gooey decorator!
 # (this code allows to only use Gooey when no arguments are passed to the script)
 if len(sys.argv) >= 2:
@@ -188,6 +621,7 @@ def main_cli():
     input_dir
     output
     recursive :: True
+    sweep ::
     bleach_correction :: True
     correction_region_size :: 150
     project_values :: vertical
@@ -197,6 +631,15 @@ def main_cli():
     Koff_initial :: 0.1
     minimum_Lf :: 8.0
     maximum_Lf :: 16.0
+    fit_frames :: 1000
+    time_sampling :: first
+    engine :: series
+    time_limit :: 0
+    max_nfev :: 0
+    no_plots :: False
+    channels :: all
+    z_planes :: all
+    workers :: 0
 
     """
 
@@ -213,7 +656,7 @@ def main_cli():
         "-d",
         "--input_dir",
         required=True,
-        help="Input Folder containing movies (.tif)",
+        help="Input Folder containing movies (.tif or OME-Zarr .zarr)",
         widget="DirChooser",
     )
 
@@ -238,6 +681,14 @@ def main_cli():
         },
     )
 
+    in_movies_parser.add_argument(
+        "-s",
+        "--sweep",
+        help="Parameter grid (.json) mapping parameter names to lists of values, e. g. {\"roi_ext_factor\": [1.0, 1.5], \"mirror\": [\"first_half\", \"no\"]}. All combinations are fitted, parameters not in the grid take the values below.",
+        widget="FileChooser",
+        default=None,
+    )
+
     bleach_corr_parser = parser.add_argument_group("Bleach correction")
 
     bleach_corr_parser.add_argument(
@@ -334,15 +785,137 @@ def main_cli():
         default=16
     )
 
+    fitting_parser.add_argument(
+        "-n",
+        "--fit_frames",
+        widget="IntegerField",
+        gooey_options={"min": 2, "max": 100000, "increment": 10, "initial_value": 1000},
+        help="Maximum number of post-bleach frames used for fitting (R2 uses all frames)",
+        type=int,
+        default=1000,
+    )
+
+    fitting_parser.add_argument(
+        "-ts",
+        "--time_sampling",
+        widget="Dropdown",
+        choices=["first", "log", "weighted"],
+        help="Selection of the fitted frames: the first ones, log-spaced, or weighted by the profile change",
+        gooey_options={"initial_value": "first"},
+        type=str,
+        default="first",
+    )
+
+    fitting_parser.add_argument(
+        "-eng",
+        "--engine",
+        widget="Dropdown",
+        choices=["series", "crank_nicolson"],
+        help="Forward model: Fourier series solution or implicit (Crank-Nicolson) time-stepping",
+        gooey_options={"initial_value": "series"},
+        type=str,
+        default="series",
+    )
+
+    fitting_parser.add_argument(
+        "-tl",
+        "--time_limit",
+        widget="DecimalField",
+        gooey_options={"min": 0, "max": 86400, "increment": 10, "initial_value": 0},
+        help="Time limit of each fit in seconds, the best parameters found so far are used (0: no limit)",
+        type=float,
+        default=0,
+    )
+
+    fitting_parser.add_argument(
+        "-nfev",
+        "--max_nfev",
+        widget="IntegerField",
+        gooey_options={"min": 0, "max": 100000, "increment": 10, "initial_value": 0},
+        help="Maximum number of model evaluations of each fit, the best parameters found so far are used (0: no limit)",
+        type=int,
+        default=0,
+    )
+
+    fitting_parser.add_argument(
+        "-np",
+        "--no_plots",
+        action="store_true",
+        help="Do not save the plots of data and fitted model for each frame (always skipped for parameter sweeps)",
+        default=False,
+    )
+
+    hyperstack_parser = parser.add_argument_group("Hyperstack")
+
+    hyperstack_parser.add_argument(
+        "-c",
+        "--channels",
+        help="Channels to analyze, e. g. '0,2' ('all' for every channel)",
+        type=str,
+        default="all",
+    )
+
+    hyperstack_parser.add_argument(
+        "-z",
+        "--z_planes",
+        help="Z-planes to analyze, e. g. '0,1,2' ('all' for every z-plane)",
+        type=str,
+        default="all",
+    )
+
+    hyperstack_parser.add_argument(
+        "-j",
+        "--workers",
+        widget="IntegerField",
+        gooey_options={"min": 0, "max": 256, "increment": 1, "initial_value": 0},
+        help="Number of parallel processes for fitting the planes of a movie (0: number of CPUs)",
+        type=int,
+        default=0,
+    )
+
     args = parser.parse_args()
 
     for key, value in vars(args).items():
         print(f"{key} :: {value}")
 
-    if args.recursive:
-        all_mov_fns = [path for path in Path(args.input_dir).rglob("*.tif")]
-    else:
-        all_mov_fns = [path for path in Path(args.input_dir).glob("*.tif")]
+    all_mov_fns = []
+    for pattern in ["*.tif", "*.zarr"]:
+        if args.recursive:
+            all_mov_fns += [path for path in Path(args.input_dir).rglob(pattern)]
+        else:
+            all_mov_fns += [path for path in Path(args.input_dir).glob(pattern)]
+
+    params = dict(
+        bleach_correction=args.bleach_correction,
+        roi_ext_factor=args.extend,
+        project_on=args.project_values[0],
+        mirror=args.mirror_values,
+        D_guess=args.D_initial,
+        koff_guess=args.Koff_initial,
+        min_l_f=args.minimum_Lf,
+        max_l_f=args.maximum_Lf,
+        correction_region_size=args.correction_region_size,
+        max_num_points=args.fit_frames,
+        time_sampling=args.time_sampling,
+        engine=args.engine,
+        time_limit=args.time_limit or None,
+        max_nfev=args.max_nfev or None,
+    )
+
+    if args.sweep:
+        with open(args.sweep) as fh:
+            grid = json.load(fh)
+
+        tab = sweep_frap_parameters(
+            all_mov_fns,
+            grid,
+            channels=parse_index_list(args.channels),
+            z_planes=parse_index_list(args.z_planes),
+            n_workers=args.workers or None,
+            **params,
+        )
+        tab.to_csv(args.output, sep="\t")
+        return
 
     results = []
     n = len(all_mov_fns)
@@ -350,19 +923,15 @@ def main_cli():
         print(f"\n# {i+1}/{n} ### {mov_fn}")
         sys.stdout.flush()
         try:
-            result_dict = extract_frap_profiles_and_fit(
+            result_dicts = extract_hyperstack_profiles_and_fit(
                 mov_fn=mov_fn,
-                bleach_correction=args.bleach_correction,
-                roi_ext_factor=args.extend,
-                project_on=args.project_values[0],
-                mirror=args.mirror_values,
-                D_guess=args.D_initial,
-                koff_guess=args.Koff_initial,
-                min_l_f=args.minimum_Lf,
-                max_l_f=args.maximum_Lf,
-                correction_region_size=args.correction_region_size,
+                channels=parse_index_list(args.channels),
+                z_planes=parse_index_list(args.z_planes),
+                n_workers=args.workers or None,
+                plot=not args.no_plots,
+                **params,
             )
-            results.append(result_dict)
+            results.extend(result_dicts)
         except:
 
             print(f"\nERROR for file '{mov_fn}'\n")
@@ -0,0 +1,380 @@
+import os
+import numpy
+import roifile
+import tifffile
+import xml.etree.ElementTree as ET
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+ZARR_SUFFIXES = (".zarr",)
+
+# factors to micrometers and seconds, for the NGFF (UDUNITS-2) unit names and
+# the OME-XML unit symbols
+LENGTH_UNITS = {
+    "angstrom": 1e-4,
+    "\u00c5": 1e-4,
+    "picometer": 1e-6,
+    "pm": 1e-6,
+    "nanometer": 1e-3,
+    "nm": 1e-3,
+    "micrometer": 1.0,
+    "micron": 1.0,
+    "\u00b5m": 1.0,
+    "\u03bcm": 1.0,
+    "um": 1.0,
+    "millimeter": 1e3,
+    "mm": 1e3,
+    "centimeter": 1e4,
+    "cm": 1e4,
+    "meter": 1e6,
+    "m": 1e6,
+}
+TIME_UNITS = {
+    "nanosecond": 1e-9,
+    "ns": 1e-9,
+    "microsecond": 1e-6,
+    "\u00b5s": 1e-6,
+    "\u03bcs": 1e-6,
+    "us": 1e-6,
+    "millisecond": 1e-3,
+    "ms": 1e-3,
+    "second": 1.0,
+    "s": 1.0,
+    "minute": 60.0,
+    "min": 60.0,
+    "hour": 3600.0,
+    "h": 3600.0,
+}
+
+
+def is_zarr_movie(mov_fn):
+    return Path(mov_fn).suffix.lower() in ZARR_SUFFIXES
+
+
+def get_physical_units_from_imagej_tif(tif_fn):
+    with tifffile.TiffFile(tif_fn) as tif:
+        assert tif.is_imagej
+        tags = tif.pages[0].tags
+        y_resolution = tags["YResolution"].value
+        finterval = tif.imagej_metadata["finterval"]
+
+        pixel_size = y_resolution[1] / y_resolution[0]
+        return pixel_size, finterval
+
+
+def read_sidecar_roi(mov_fn):
+    extra_roi_file = str(Path(mov_fn).with_suffix(".roi"))
+    if os.path.exists(extra_roi_file):
+        return roifile.ImagejRoi.fromfile(extra_roi_file)
+    return None
+
+
+def read_imagej_tif_roi(mov_fn):
+    roi = roifile.ImagejRoi.fromfile(str(mov_fn))
+    if len(roi) == 0:
+        roi = read_sidecar_roi(mov_fn)
+        if roi is None:
+            extra_roi_file = Path(mov_fn).with_suffix(".roi")
+            raise RuntimeError(f"No ROI found in '{mov_fn}' or '{extra_roi_file}'")
+        print("Cannot read ROI from tiff file, using .roi file...")
+    else:
+        roi = roi[0]
+    return roi
+
+
+def movie_planes(axes, shape, channels=None, z_planes=None):
+    """
+    List the (T, Y, X) planes of a hyperstack as dicts {axis: index}
+
+    Only axes besides T, Y and X with more than one entry are listed.
+    Channels and z-planes can be restricted by passing lists of indices,
+    indices the movie does not have raise a ValueError.
+    """
+    axes = axes.lower()
+    selection = {"c": channels, "z": z_planes}
+
+    for ax, indices in selection.items():
+        size = shape[axes.index(ax)] if ax in axes else 1
+        for i in indices or []:
+            if not 0 <= i < size:
+                raise ValueError(
+                    f"Index {i} out of range for axis '{ax}' of size {size} "
+                    f"in movie with axes '{axes}'"
+                )
+
+    planes = [{}]
+    for ax, size in zip(axes, shape):
+        if ax in "tyx" or size == 1:
+            continue
+
+        indices = selection.get(ax)
+        if indices is None:
+            indices = range(size)
+
+        planes = [{**plane, ax: i} for plane in planes for i in indices]
+
+    return planes
+
+
+def plane_suffix(plane):
+    return "".join(f"_{ax}{i}" for ax, i in plane.items())
+
+
+def _plane_index(axes, shape, plane, per_axis):
+    index = []
+    for ax, size in zip(axes, shape):
+        if ax in per_axis:
+            index.append(per_axis[ax])
+        elif ax in plane:
+            index.append(plane[ax])
+        elif size == 1:
+            index.append(0)
+        else:
+            raise ValueError(f"No plane selected on axis '{ax}' of movie with axes '{axes}'")
+
+    # keep the result in (T, Y, X) order, whatever the order on disk
+    order = [ax for ax in axes if ax in per_axis]
+    return tuple(index), [order.index(ax) for ax in "tyx"]
+
+
+def select_plane(mov, axes, plane, max_workers=8):
+    """
+    Select one (T, Y, X) plane of a hyperstack
+
+    NumPy (and memory-mapped) arrays return a view, Zarr arrays a lazy
+    ZarrMovie.
+    """
+    if isinstance(mov, numpy.ndarray):
+        all_slices = {ax: slice(None) for ax in "tyx"}
+        index, order = _plane_index(axes, mov.shape, plane, all_slices)
+        return numpy.transpose(mov[index], order)
+
+    return ZarrMovie(mov, axes, plane=plane, max_workers=max_workers)
+
+
+class ZarrMovie:
+    """
+    Lazy (T, Y, X) view on one plane of a chunked Zarr array
+
+    Indexing reads only the chunks overlapping the requested region. The
+    time axis is split along its chunk boundaries and the blocks are fetched
+    in parallel with a thread pool.
+    """
+
+    def __init__(self, array, axes, plane=None, max_workers=8):
+        self.array = array
+        self.axes = axes.lower()
+        self.plane = plane or {}
+        self.max_workers = max_workers
+
+        for ax in "tyx":
+            if ax not in self.axes:
+                raise ValueError(f"Zarr array with axes '{axes}' has no '{ax}' axis")
+
+    @property
+    def shape(self):
+        return tuple(self.array.shape[self.axes.index(ax)] for ax in "tyx")
+
+    def __getitem__(self, key):
+        key = key + (slice(None),) * (3 - len(key))
+        t_slice, y_slice, x_slice = key
+
+        t_start, t_stop, _ = t_slice.indices(self.shape[0])
+        t_chunk = self.array.chunks[self.axes.index("t")]
+
+        blocks = []
+        start = t_start
+        while start < t_stop:
+            stop = min((start // t_chunk + 1) * t_chunk, t_stop)
+            blocks.append(slice(start, stop))
+            start = stop
+
+        def read_block(block):
+            per_axis = {"t": block, "y": y_slice, "x": x_slice}
+            index, order = _plane_index(
+                self.axes, self.array.shape, self.plane, per_axis
+            )
+            return numpy.transpose(self.array[index], order)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            data = list(pool.map(read_block, blocks))
+
+        return numpy.concatenate(data, axis=0)
+
+
+def _to_unit(value, unit, units, what):
+    # no unit given: the value is assumed to be in micrometers / seconds
+    if unit is None:
+        return value
+    if unit not in units:
+        raise ValueError(f"Unknown {what} unit '{unit}'")
+    return value * units[unit]
+
+
+def _ome_zarr_multiscales(attrs):
+    # OME-NGFF >= 0.5 nests the metadata under 'ome'
+    if "ome" in attrs:
+        attrs = attrs["ome"]
+    if "multiscales" not in attrs:
+        return None
+    return attrs["multiscales"][0]
+
+
+def _ome_xml_metadata(zarr_fn):
+    # bioformats2raw layout keeps the full OME-XML next to the series groups
+    xml_fn = os.path.join(str(zarr_fn), "OME", "METADATA.ome.xml")
+    if not os.path.exists(xml_fn):
+        return None
+
+    root = ET.parse(xml_fn).getroot()
+    ns = {"ome": root.tag.split("}")[0].strip("{")} if "}" in root.tag else {}
+    prefix = "ome:" if ns else ""
+
+    pixels = root.find(f".//{prefix}Pixels", ns)
+    rect = root.find(f".//{prefix}ROI//{prefix}Rectangle", ns)
+
+    pixel_size = finterval = roi = None
+    if pixels is not None:
+        if "PhysicalSizeY" in pixels.attrib:
+            pixel_size = _to_unit(
+                float(pixels.attrib["PhysicalSizeY"]),
+                pixels.attrib.get("PhysicalSizeYUnit"),
+                LENGTH_UNITS,
+                "length",
+            )
+        if "TimeIncrement" in pixels.attrib:
+            finterval = _to_unit(
+                float(pixels.attrib["TimeIncrement"]),
+                pixels.attrib.get("TimeIncrementUnit"),
+                TIME_UNITS,
+                "time",
+            )
+
+    if rect is not None:
+        left = int(round(float(rect.attrib["X"])))
+        top = int(round(float(rect.attrib["Y"])))
+        roi = roifile.ImagejRoi(
+            roitype=roifile.ROI_TYPE.RECT,
+            left=left,
+            top=top,
+            right=left + int(round(float(rect.attrib["Width"]))),
+            bottom=top + int(round(float(rect.attrib["Height"]))),
+        )
+
+    return pixel_size, finterval, roi
+
+
+def open_ome_zarr(zarr_fn):
+    import zarr
+
+    group = zarr.open_group(str(zarr_fn), mode="r")
+
+    # bioformats2raw puts each series of the converted file in its own group,
+    # only the first series is used
+    attrs = dict(group.attrs)
+    if "bioformats2raw.layout" in attrs.get("ome", attrs):
+        group = group["0"]
+
+    multiscales = _ome_zarr_multiscales(dict(group.attrs))
+
+    if multiscales is None:
+        raise RuntimeError(f"No OME-Zarr multiscales metadata found in '{zarr_fn}'")
+
+    # NGFF 0.3 lists the axes by name, later versions as dicts with units
+    axes_meta = [ax if isinstance(ax, dict) else {"name": ax} for ax in multiscales["axes"]]
+    axes = "".join(ax["name"] for ax in axes_meta).lower()
+    units = [ax.get("unit") for ax in axes_meta]
+    dataset = multiscales["datasets"][0]
+
+    # NGFF 0.4+ applies the multiscales-level transformations after the
+    # dataset-level ones, both scales multiply
+    transforms = dataset.get("coordinateTransformations", []) + multiscales.get(
+        "coordinateTransformations", []
+    )
+    scales = [
+        numpy.asarray(transform["scale"], dtype=float)
+        for transform in transforms
+        if transform["type"] == "scale"
+    ]
+
+    pixel_size = finterval = None
+    if len(scales) > 0:
+        scale = numpy.prod(scales, axis=0)
+        y = axes.index("y")
+        pixel_size = _to_unit(float(scale[y]), units[y], LENGTH_UNITS, "length")
+        if "t" in axes:
+            t = axes.index("t")
+            finterval = _to_unit(float(scale[t]), units[t], TIME_UNITS, "time")
+
+    roi = None
+    ome_xml = _ome_xml_metadata(zarr_fn)
+    if ome_xml is not None:
+        xml_pixel_size, xml_finterval, roi = ome_xml
+        pixel_size = pixel_size or xml_pixel_size
+        finterval = finterval or xml_finterval
+
+    if roi is None:
+        roi = read_sidecar_roi(zarr_fn)
+    if roi is None:
+        raise RuntimeError(
+            f"No ROI found in OME metadata of '{zarr_fn}' or in '{Path(zarr_fn).with_suffix('.roi')}'"
+        )
+
+    if pixel_size is None or finterval is None:
+        raise RuntimeError(f"Cannot read pixel size and frame interval from '{zarr_fn}'")
+
+    return group[dataset["path"]], axes, roi, pixel_size, finterval
+
+
+def _open_tif_series(tif_fn):
+    # uncompressed stacks (as written by ImageJ) are memory-mapped, compressed
+    # ones opened as chunked Zarr array, one chunk per image
+    try:
+        return tifffile.memmap(tif_fn, mode="r")
+    except ValueError:
+        pass
+
+    try:
+        import zarr
+    except ImportError:
+        return tifffile.imread(tif_fn)
+
+    tif = tifffile.TiffFile(tif_fn)
+    return zarr.open(tif.series[0].aszarr(), mode="r")
+
+
+def read_imagej_tif(tif_fn):
+    with tifffile.TiffFile(tif_fn) as tif:
+        axes = tif.series[0].axes.lower()
+    mov = _open_tif_series(tif_fn)
+
+    # plain ImageJ stacks without hyperstack metadata (e. g. saved as slices)
+    # have no time axis, use their single stack axis as time
+    if "t" not in axes:
+        stack_axes = [ax for ax, size in zip(axes, mov.shape) if ax not in "yx"]
+        if len(stack_axes) != 1:
+            raise RuntimeError(f"Cannot find time axis in '{tif_fn}' with axes '{axes}'")
+        axes = axes.replace(stack_axes[0], "t")
+
+    return mov, axes
+
+
+def open_movie(mov_fn):
+    """
+    Open movie, returns (mov, axes, roi, pixel_size, finterval)
+
+    Movies are opened lazily: ImageJ .tif (hyper)stacks are memory-mapped
+    (or, if compressed, read image by image), OME-Zarr movies read chunk by
+    chunk, so only the indexed regions are fetched from storage. Use
+    movie_planes and select_plane to get the (T, Y, X) planes.
+    """
+    if is_zarr_movie(mov_fn):
+        return open_ome_zarr(mov_fn)
+
+    roi = read_imagej_tif_roi(mov_fn)
+    pixel_size, finterval = get_physical_units_from_imagej_tif(str(mov_fn))
+    mov, axes = read_imagej_tif(str(mov_fn))
+
+    return mov, axes, roi, pixel_size, finterval
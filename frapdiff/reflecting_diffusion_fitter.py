@@ -21,138 +21,321 @@
 """
 
 import os, sys
+import time
+import functools
 import numpy as np
-import scipy, scipy.optimize
+import scipy, scipy.optimize, scipy.linalg.lapack
 import matplotlib.pyplot as plt
 
 
-def run_fitter(
-    filepath,
-    cell_name,
+class FitBudgetExceeded(Exception):
+    """
+    Raised inside the model, when the fit exceeds its time or evaluation budget
+    """
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def _spread_frames(values, budget):
+    """
+    Pick budget distinct frames, evenly spread along the increasing values
+    """
+    n_frames = len(values)
+    frames = [0]
+    for k in range(1, budget):
+        remaining = budget - k
+        target = values[frames[-1]] + (values[-1] - values[frames[-1]]) / remaining
+        frame = max(frames[-1] + 1, int(np.searchsorted(values, target)))
+        frames.append(min(frame, n_frames - remaining))
+
+    return np.array(frames)
+
+
+def select_fit_frames(frames, max_num_points=1000, time_sampling="first"):
+    """
+    Select the frames used for fitting
+
+    frames: array of shape (positions, frames)
+    time_sampling:
+        'first': the first max_num_points frames
+        'log': max_num_points log-spaced frames, dense at the start of the recovery
+        'weighted': max_num_points frames spread evenly over the cumulative
+                    change of the profiles, dense where the recovery is fast
+    """
+    n_frames = frames.shape[1]
+    budget = min(int(max_num_points), n_frames)
+
+    if time_sampling == "first" or budget == n_frames:
+        return np.arange(budget)
+    elif time_sampling == "log":
+        values = np.log(np.arange(1, n_frames + 1))
+    elif time_sampling == "weighted":
+        change = np.sqrt((np.diff(frames, axis=1) ** 2).sum(axis=0))
+        values = np.r_[0.0, np.cumsum(change)]
+    else:
+        raise ValueError(
+            f"time_sampling not understood. Use 'first', 'log', or 'weighted'"
+        )
+
+    return _spread_frames(values, budget)
+
+
+def crank_nicolson_reflect(u0, h, D, dt, record_steps, startup_steps=1):
+    """
+    Diffuse the cell values u0 (cell size h) with reflecting boundaries
+
+    Takes Crank-Nicolson steps of size dt with one tridiagonal solve per step.
+    The first startup_steps are each replaced by two implicit Euler half-steps
+    (Rannacher start-up), which damp the oscillations Crank-Nicolson shows for
+    the discontinuous initial profile. Returns the cell values after each of
+    the increasing step counts in record_steps.
+    """
+    n_cells = len(u0)
+    c = 0.5 * D * dt / (h * h)
+
+    # (I - c A), A: second differences with zero flux at both ends. Implicit
+    # Euler half-steps and Crank-Nicolson steps share it, so it is factorized once
+    diag = np.full(n_cells, 1.0 + 2.0 * c)
+    diag[0] = diag[-1] = 1.0 + c
+    off_diag = np.full(n_cells - 1, -c)
+    dl, d, du, du2, ipiv, info = scipy.linalg.lapack.dgttrf(off_diag, diag, off_diag)
+
+    def solve(rhs):
+        return scipy.linalg.lapack.dgttrs(dl, d, du, du2, ipiv, rhs)[0]
+
+    # (I + c A)
+    rhs_diag = 2.0 - diag
+
+    u = np.array(u0, dtype=float)
+    recorded = []
+    step = 0
+    for record_step in record_steps:
+        while step < record_step:
+            step += 1
+            if step <= startup_steps:
+                u = solve(solve(u))
+            else:
+                rhs = rhs_diag * u
+                rhs[:-1] += c * u[1:]
+                rhs[1:] += c * u[:-1]
+                u = solve(rhs)
+        recorded.append(u)
+
+    return np.array(recorded)
+
+
+def reflect_diffusion_model(
+    x_positions,
+    segment_intensities,
     I0,
+    I1,
     t_step_size,
-    D_guess,
-    koff_guess,
-    min_l_f=2.0,
-    max_l_f=10.0,
-    max_num_points=1000,
+    engine="series",
     max_n=500,
-    x_d=0.0,
-    x_e=0.0,
+    basis_cache_size=64,
+    pde_grid_step=None,
+    pde_substeps=4,
 ):
+    """
+    Forward model of the reflecting diffusion problem for one initial profile
+
+    x_positions: positions of the profile
+    segment_intensities: intensities between neighboring positions
+    I0, I1: intensities left and right of the profile
+
+    Returns (model, model_cache): model(data, D, koff, Iinf) gives the
+    intensities at data = [positions, times], model_cache is the lru_cache of
+    its Iinf-dependent terms. See run_fitter for the engine options.
+    """
+    x_positions = np.asarray(x_positions, dtype=float)
+    segment_intensities = np.asarray(segment_intensities, dtype=float)
+
+    # a single position has no extent, x_l and the domain would be empty
+    if len(x_positions) < 2:
+        raise ValueError(
+            f"Profile needs at least two positions, got {len(x_positions)}"
+        )
+    x_d = x_positions[0]
+    x_e = x_positions[-1]
+    z_integral = float(np.sum(segment_intensities * np.diff(x_positions)))
 
-    I1 = I0
+    def reflect_domain(Iinf):
+        """
+        x_l, the domain [x_a, x_b] and its mean intensity for Iinf
+        """
+        x_l = (Iinf * (x_d - x_e) + z_integral) / (2 * Iinf - I0 - I1)
 
-    x_initial = []
-    z_initial = []
+        if x_l < 0.0:
+            raise ValueError(
+                "x_l less than zero: " + str(x_l) + ", Iinf may not be maintained"
+            )
 
-    # number of additional neighbors to include in averaging
-    include_neighbor_count = 0
+        x_a = x_d - x_l
+        x_b = x_e + x_l
 
-    def diffusion_reflect(data, D, koff, Iinf):
-        x = data[0]
-        t = data[1]
+        mean_intensity = (z_integral + I0 * (x_d - x_a) + I1 * (x_b - x_e)) / (
+            x_b - x_a
+        )
 
-        result = 0.0
-        for i in range(0, len(x_initial) - 1):
-            avg_intensity = 0.0
-            avg_intensity_count = 0
-            for j in range(i - include_neighbor_count, i + include_neighbor_count + 2):
-                if j >= 0 and j < len(x_initial):
-                    avg_intensity += z_initial[j]
-                    avg_intensity_count += 1
+        return x_l, x_a, x_b, mean_intensity
 
-            avg_intensity = avg_intensity / float(avg_intensity_count)
+    @functools.lru_cache(maxsize=basis_cache_size)
+    def reflect_basis(Iinf):
+        """
+        All terms of the series solution depending only on Iinf: the domain,
+        lambda_n, the coefficients of the initial profile and
+        cos(lambda_n (x - x_a)) at the profile positions
+        """
+        x_l, x_a, x_b, mean_intensity = reflect_domain(Iinf)
 
-            x_diff = x_initial[i + 1] - x_initial[i]
+        lambdas = np.arange(1, max_n + 1) * np.pi / (x_b - x_a)
+        sin_initial = np.sin(np.outer(lambdas, x_positions - x_a))
 
-            result += avg_intensity * x_diff
+        coefs = (
+            np.diff(sin_initial, axis=1) @ segment_intensities
+            + I0 * (np.sin(lambdas * (x_d - x_a)) - np.sin(lambdas * (x_a - x_a)))
+            + I1 * (np.sin(lambdas * (x_b - x_a)) - np.sin(lambdas * (x_e - x_a)))
+        ) / lambdas
 
-        x_l = (Iinf * (x_d - x_e) + result) / (2 * Iinf - I0 - I1)
-        # x_l = 25
+        cos_initial = np.cos(np.outer(lambdas, x_positions - x_a))
+
+        return x_l, x_a, x_b, mean_intensity, lambdas, coefs, cos_initial
+
+    def diffusion_reflect(data, D, koff, Iinf):
+        x = data[0]
+        t = data[1]
+
+        x_l, x_a, x_b, mean_intensity, lambdas, coefs, cos_initial = reflect_basis(
+            Iinf
+        )
 
         print(
             f"     - D = {D:0.6f}, koff = {koff:0.6f}, Iinf = {Iinf:0.6f}, x_l = {x_l:0.6f}"
         )
         sys.stdout.flush()
 
-        if x_l < 0.0:
-            raise ValueError(
-                "x_l less than zero: " + str(x_l) + ", Iinf may not be maintained"
-            )
-            x_l = 0.0
+        # evaluate the series on the grid of unique positions and times,
+        # only the exponentials depend on D and koff
+        x_unique, x_index = np.unique(x, return_inverse=True)
+        t_unique, t_index = np.unique(t, return_inverse=True)
 
-            x_a = x_d
-            x_b = x_e
+        if np.array_equal(x_unique, x_positions):
+            cos_x = cos_initial
         else:
-            x_a = x_d - x_l
-            x_b = x_e + x_l
+            cos_x = np.cos(np.outer(lambdas, x_unique - x_a))
+
+        exp_t = np.exp(-D * np.outer(lambdas * lambdas, t_unique))
+        result_two = (cos_x * coefs[:, None]).T @ exp_t
+        result_two = 2.0 * np.exp(-koff * t_unique) / (x_b - x_a) * result_two
+
+        return mean_intensity + result_two[x_index.ravel(), t_index.ravel()]
+
+    @functools.lru_cache(maxsize=basis_cache_size)
+    def pde_grid(Iinf):
+        """
+        Cell centers over [x_a, x_b] and the cell averages of the initial
+        profile: I0 / I1 outside of the profile, the segment intensities inside
+        """
+        x_l, x_a, x_b, mean_intensity = reflect_domain(Iinf)
+
+        grid_step = pde_grid_step or 0.5 * (x_positions[1] - x_positions[0])
+        n_cells = int(np.ceil((x_b - x_a) / grid_step))
+        h = (x_b - x_a) / n_cells
+        edges = x_a + h * np.arange(n_cells + 1)
+
+        # the integral of the piecewise constant initial profile is piecewise
+        # linear, interpolating it at the cell edges gives exact cell averages
+        knots = np.r_[x_a, x_positions, x_b]
+        integral = np.cumsum(
+            np.r_[
+                0.0,
+                I0 * (x_d - x_a),
+                segment_intensities * np.diff(x_positions),
+                I1 * (x_b - x_e),
+            ]
+        )
+        u0 = np.diff(np.interp(edges, knots, integral)) / h
 
-        x_diff = x_d - x_a
-        result += I0 * x_diff
+        return x_l, mean_intensity, h, 0.5 * (edges[:-1] + edges[1:]), u0
 
-        x_diff = x_b - x_e
-        result += I1 * x_diff
+    def diffusion_reflect_pde(data, D, koff, Iinf):
+        x = data[0]
+        t = data[1]
 
-        result = result / (x_b - x_a)
+        x_l, mean_intensity, h, centers, u0 = pde_grid(Iinf)
 
-        sums = [0.0] * (len(x_initial) - 1)
-        sum_left = 0.0
-        sum_right = 0.0
+        print(
+            f"     - D = {D:0.6f}, koff = {koff:0.6f}, Iinf = {Iinf:0.6f}, x_l = {x_l:0.6f}"
+        )
+        sys.stdout.flush()
 
-        result_two = 0.0
+        x_unique, x_index = np.unique(x, return_inverse=True)
+        t_unique, t_index = np.unique(t, return_inverse=True)
 
-        for n in range(1, max_n + 1):
-            lambda_n = n * np.pi / (x_b - x_a)
-            middle_term = (
-                np.exp(-D * t * lambda_n * lambda_n)
-                / lambda_n
-                * np.cos(lambda_n * (x - x_a))
-            )
+        dt = t_step_size / pde_substeps
+        record_steps = np.round(t_unique / dt).astype(int)
+        u = crank_nicolson_reflect(u0, h, D, dt, record_steps)
 
-            for i in range(0, len(x_initial) - 1):
-                avg_intensity = 0.0
-                avg_intensity_count = 0
-                for j in range(
-                    i - include_neighbor_count, i + include_neighbor_count + 2
-                ):
-                    if j >= 0 and j < len(x_initial):
-                        avg_intensity += z_initial[j]
-                        avg_intensity_count += 1
-
-                avg_intensity = avg_intensity / float(avg_intensity_count)
-
-                sums[i] += (
-                    avg_intensity
-                    * middle_term
-                    * (
-                        np.sin(lambda_n * (x_initial[i + 1] - x_a))
-                        - np.sin(lambda_n * (x_initial[i] - x_a))
-                    )
-                )
+        # diffusion conserves the mean, koff decays the deviation from it
+        result_two = np.array([np.interp(x_unique, centers, u_t) for u_t in u]).T
+        result_two = np.exp(-koff * t_unique) * (result_two - mean_intensity)
 
-            sum_left += (
-                I0
-                * middle_term
-                * (np.sin(lambda_n * (x_d - x_a)) - np.sin(lambda_n * (x_a - x_a)))
-            )
-            sum_right += (
-                I1
-                * middle_term
-                * (np.sin(lambda_n * (x_b - x_a)) - np.sin(lambda_n * (x_e - x_a)))
-            )
+        return mean_intensity + result_two[x_index.ravel(), t_index.ravel()]
 
-        for i in range(0, len(x_initial) - 1):
-            result_two += sums[i]
+    if engine == "series":
+        return diffusion_reflect, reflect_basis
+    elif engine == "crank_nicolson":
+        return diffusion_reflect_pde, pde_grid
+    else:
+        raise ValueError(f"engine not understood. Use 'series' or 'crank_nicolson'")
 
-        result_two += sum_left
-        result_two += sum_right
 
-        result_two = 2.0 * np.exp(-koff * t) / (x_b - x_a) * result_two
+def run_fitter(
+    filepath,
+    cell_name,
+    I0,
+    t_step_size,
+    D_guess,
+    koff_guess,
+    min_l_f=2.0,
+    max_l_f=10.0,
+    max_num_points=1000,
+    time_sampling="first",
+    max_n=500,
+    x_d=0.0,
+    x_e=0.0,
+    basis_cache_size=64,
+    time_limit=None,
+    max_nfev=None,
+    engine="series",
+    pde_grid_step=None,
+    pde_substeps=4,
+    plot=True,
+):
+    """
+    engine: forward model, 'series' (Fourier series with max_n terms) or
+        'crank_nicolson' (implicit time-stepping on a grid over [x_a, x_b] with
+        pde_grid_step, default half the pixel size, and pde_substeps time
+        steps per frame)
+    time_limit: wall-clock limit of the fit in seconds
+    max_nfev: limit of model evaluations, including the ones for the Jacobian
+    plot: save a plot of data and fitted model for each frame to Images\\<cell_name>
+
+    When a limit is exceeded, the fit is stopped and the best parameters found
+    so far are used (fitStatus 'timeout' or 'max_nfev' instead of 'converged').
+    """
 
-        return result + result_two
+    I1 = I0
+
+    x_initial = []
+    z_initial = []
+
+    # number of additional neighbors to include in averaging
+    include_neighbor_count = 0
 
-    def IndividualLineComparisons(func, data, fittedParameters):
+    def IndividualLineComparisons(func, data, fittedParameters, fit_frames):
         x_data = data[0]
         y_data = data[1]
         z_data = data[2]
@@ -259,11 +442,11 @@ def run_fitter(
         except OSError as error:
             print(error)
 
-        count = 0
-        for key, value in z_by_time_dict.items():
+        # the times are in frame order, frames used for fitting are plotted red
+        for frame, (key, value) in enumerate(z_by_time_dict.items()):
             plt.plot(x_initial, z_by_time_dict[key], color="b", marker=".")
 
-            if count < max_num_points:
+            if frame in fit_frames:
                 plt.plot(
                     unique_x_data_extended,
                     z_predicted_by_time_dict[key],
@@ -285,7 +468,6 @@ def run_fitter(
             plt.savefig("Images\\" + cell_name + "\\" + str(key) + ".png")
             plt.clf()
             # plt.show()
-            count += 1
 
     x = []
     z = []
@@ -295,26 +477,31 @@ def run_fitter(
     full_z = []
     full_t = []
 
-    with open(filepath) as fp:
-        line = fp.readline()
+    # profiles are given as file path or as array, one row per position:
+    # location followed by the intensities of each frame
+    if isinstance(filepath, np.ndarray):
+        profiles = filepath
+    else:
+        profiles = np.loadtxt(filepath, ndmin=2)
 
-        while line:
-            splitString = line.split()
-
-            x_initial.append(float(splitString[0]))
-            z_initial.append(float(splitString[1]))
+    # frames used for fitting, R-squared is computed on all frames
+    fit_frames = set(
+        select_fit_frames(profiles[:, 1:], max_num_points, time_sampling).tolist()
+    )
 
-            for i in range(1, len(splitString)):
-                if i <= max_num_points:
-                    x.append(float(splitString[0]))
-                    z.append(float(splitString[i]))
-                    t.append(i - 1)
+    for splitString in profiles:
+        x_initial.append(float(splitString[0]))
+        z_initial.append(float(splitString[1]))
 
-                full_x.append(float(splitString[0]))
-                full_z.append(float(splitString[i]))
-                full_t.append(i - 1)
+        for i in range(1, len(splitString)):
+            if i - 1 in fit_frames:
+                x.append(float(splitString[0]))
+                z.append(float(splitString[i]))
+                t.append(i - 1)
 
-            line = fp.readline()
+            full_x.append(float(splitString[0]))
+            full_z.append(float(splitString[i]))
+            full_t.append(i - 1)
 
     x_d = x_initial[0]
     x_e = x_initial[-1]
@@ -331,6 +518,7 @@ def run_fitter(
     full_t = full_t * t_step_size
 
     result = 0.0
+    segment_intensities = []
     for i in range(0, len(x_initial) - 1):
         avg_intensity = 0.0
         avg_intensity_count = 0
@@ -340,11 +528,26 @@ def run_fitter(
                 avg_intensity_count += 1
 
         avg_intensity = avg_intensity / float(avg_intensity_count)
+        segment_intensities.append(avg_intensity)
 
         x_diff = x_initial[i + 1] - x_initial[i]
 
         result += avg_intensity * x_diff
 
+    # the initial profile does not change during fitting
+    model, model_cache = reflect_diffusion_model(
+        x_initial,
+        segment_intensities,
+        I0,
+        I1,
+        t_step_size,
+        engine=engine,
+        max_n=max_n,
+        basis_cache_size=basis_cache_size,
+        pde_grid_step=pde_grid_step,
+        pde_substeps=pde_substeps,
+    )
+
     Iinf_min = (result + min_l_f * I0 + min_l_f * I1) / (2 * min_l_f + x_e - x_d)
     Iinf_max = (result + max_l_f * I0 + max_l_f * I1) / (2 * max_l_f + x_e - x_d)
 
@@ -356,16 +559,43 @@ def run_fitter(
 
     data = [full_x, full_t, full_z]
 
-    fittedParameters, pcov = scipy.optimize.curve_fit(
-        diffusion_reflect,
-        [x, t],
-        z,
-        p0=initialParams,
-        bounds=([0.0, 0.0, Iinf_min], [np.inf, np.inf, Iinf_max]),
-    )
+    fit_start = time.monotonic()
+    fit_state = {"nfev": 0, "best_ss_res": np.inf, "best_params": initialParams}
+
+    def budgeted_diffusion_reflect(data, D, koff, Iinf):
+        if time_limit is not None and time.monotonic() - fit_start > time_limit:
+            raise FitBudgetExceeded("timeout")
+        if max_nfev is not None and fit_state["nfev"] >= max_nfev:
+            raise FitBudgetExceeded("max_nfev")
+        fit_state["nfev"] += 1
+
+        predictions = model(data, D, koff, Iinf)
+
+        SS_res = np.sum((predictions - z) ** 2)
+        if SS_res < fit_state["best_ss_res"]:
+            fit_state["best_ss_res"] = SS_res
+            fit_state["best_params"] = [D, koff, Iinf]
+
+        return predictions
+
+    try:
+        fittedParameters, pcov = scipy.optimize.curve_fit(
+            budgeted_diffusion_reflect,
+            [x, t],
+            z,
+            p0=initialParams,
+            bounds=([0.0, 0.0, Iinf_min], [np.inf, np.inf, Iinf_max]),
+        )
+        fit_status = "converged"
+    except FitBudgetExceeded as e:
+        print(f"     - fit stopped ({e.status}), using best parameters found so far")
+        fittedParameters = fit_state["best_params"]
+        fit_status = e.status
     # fittedParameters = initialParams
 
-    modelPredictions = diffusion_reflect(data[:2], *fittedParameters)
+    fit_time = time.monotonic() - fit_start
+
+    modelPredictions = model(data[:2], *fittedParameters)
 
     residuals = modelPredictions - full_z
 
@@ -421,12 +651,19 @@ def run_fitter(
         2 * fittedParameters[2] - I0 - I1
     )
 
-    IndividualLineComparisons(diffusion_reflect, data, fittedParameters)
+    if plot:
+        IndividualLineComparisons(model, data, fittedParameters, fit_frames)
     return {
         "D": float(fittedParameters[0]),
         "Koff": float(fittedParameters[1]),
         "R2": float(Rsquared),
         "Iinf": float(fittedParameters[2]),
         "x_l": float(xl),
+        "nFitFrames": len(fit_frames),
+        "fitStatus": fit_status,
+        "nfev": fit_state["nfev"],
+        "fitTime": float(fit_time),
+        "basisCacheHits": model_cache.cache_info().hits,
+        "basisCacheMisses": model_cache.cache_info().misses,
     }
 
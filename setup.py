@@ -29,5 +29,6 @@ setup(
     author="Christoph Sommer",
     author_email="christoph.sommer23@gmail.com",
     install_requires=["numpy", "pandas", "tifffile", "roifile", "Gooey"],
+    extras_require={"zarr": ["zarr"]},
 )
 